@@ -1,7 +1,6 @@
-import requests
 import json
 
-def get_complex_for_gene_set(gene_set):
+async def get_complex_for_gene_set(gene_set, session):
     gene_set = gene_set.replace(" ","")
     
     url = "https://www.ncbi.nlm.nih.gov/research/pubtator3-api/agentapi/complex/?"
@@ -10,12 +9,11 @@ def get_complex_for_gene_set(gene_set):
         "retmode": "json",
         "limit": 10
         }
-    response = requests.get(url, params=params)
-
-    if response.status_code == 200:
-        return json.dumps(response.json().get("results",{}))
-    else:
-        return f"Error: Unable to fetch data"
+    async with session.get(url, params=params) as response:
+        if response.status == 200:
+            return json.dumps((await response.json(content_type=None)).get("results",{}))
+        else:
+            return f"Error: Unable to fetch data"
 
 
 get_complex_for_gene_set_doc = {
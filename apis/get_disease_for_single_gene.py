@@ -1,19 +1,17 @@
-import requests
 import json
 
-def get_disease_for_single_gene(gene_name):
+async def get_disease_for_single_gene(gene_name, session):
     url = "https://www.ncbi.nlm.nih.gov/research/pubtator-api/agentapi/disease/?"
     params = {
         "name": gene_name,
         "retmode": "json",
         "limit": 100
         }
-    response = requests.get(url, params=params)
-
-    if response.status_code == 200:
-        return json.dumps(response.json().get("results",{}))
-    else:
-        return f"Error: Unable to fetch data"
+    async with session.get(url, params=params) as response:
+        if response.status == 200:
+            return json.dumps((await response.json(content_type=None)).get("results",{}))
+        else:
+            return f"Error: Unable to fetch data"
 
 # Example usage
 # gene_name = "BRCA1"  # Replace with the gene name you are interested in
@@ -1,19 +1,17 @@
-import requests
 import json
 
-def get_domain_for_single_gene(gene_name):
+async def get_domain_for_single_gene(gene_name, session):
     url = "https://www.ncbi.nlm.nih.gov/research/pubtator-api/agentapi/cdd/?"
     params = {
         "name": gene_name,
         "retmode": "json",
         "limit": 10
         }
-    response = requests.get(url, params=params)
-
-    if response.status_code == 200:
-        return json.dumps(response.json().get("results",{}))
-    else:
-        return f"Error: Unable to fetch data"
+    async with session.get(url, params=params) as response:
+        if response.status == 200:
+            return json.dumps((await response.json(content_type=None)).get("results",{}))
+        else:
+            return f"Error: Unable to fetch data"
 
 
 get_domain_for_single_gene_doc = {
@@ -1,7 +1,6 @@
 import json
-import requests
 
-def get_enrichment_for_gene_set(gene_set):
+async def get_enrichment_for_gene_set(gene_set, session):
     
     gene_set = gene_set.replace(" ","")
     gene_list = gene_set.split(",")  
@@ -16,12 +15,12 @@ def get_enrichment_for_gene_set(gene_set):
         "user_threshold": 0.05
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 200:
-        return json.dumps(response.json()["result"][:5])
-    else:
-        error_message = f"Error: {response.status_code}"
-        return error_message
+    async with session.post(url, headers=headers, data=json.dumps(payload)) as response:
+        if response.status == 200:
+            return json.dumps((await response.json(content_type=None))["result"][:5])
+        else:
+            error_message = f"Error: {response.status}"
+            return error_message
 
 get_enrichment_for_gene_set_doc = {
     "name": "get_enrichment_for_gene_set",
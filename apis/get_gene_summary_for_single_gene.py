@@ -1,8 +1,7 @@
 import json
-import requests
 import time
 
-def get_gene_summary_for_single_gene(gene_name, specie):
+async def get_gene_summary_for_single_gene(gene_name, specie, session):
 	base_url_search = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
 	base_url_summary = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
 	term = gene_name + " AND " + specie
@@ -12,8 +11,10 @@ def get_gene_summary_for_single_gene(gene_name, specie):
 		"retmode": "json",
 		"sort": "relevance"
 	}
-	search_response = requests.get(base_url_search, params=search_params)
-	gene_id = search_response.json().get('esearchresult', {}).get('idlist', [])
+	async with session.get(base_url_search, params=search_params) as search_response:
+		if search_response.status != 200:
+			return f"Error: Unable to fetch data (Status Code: {search_response.status})"
+		gene_id = (await search_response.json(content_type=None)).get('esearchresult', {}).get('idlist', [])
 
 	if gene_id:
 		# Fetch summaries for the found gene IDs
@@ -23,8 +24,10 @@ def get_gene_summary_for_single_gene(gene_name, specie):
 			"retmode": "json",
    			"sort": "relevance"
 		}
-		summary_response = requests.get(base_url_summary, params=summary_params)
-		gene_summaries = summary_response.json().get('result', {})[gene_id[0]]
+		async with session.get(base_url_summary, params=summary_params) as summary_response:
+			if summary_response.status != 200:
+				return f"Error: Unable to fetch data (Status Code: {summary_response.status})"
+			gene_summaries = (await summary_response.json(content_type=None)).get('result', {})[gene_id[0]]
 		gene_summaries.pop('locationhist')
 		return gene_summaries
 
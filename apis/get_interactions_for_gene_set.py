@@ -1,19 +1,17 @@
-import requests
 import json
 
-def get_interactions_for_gene_set(gene_set):
+async def get_interactions_for_gene_set(gene_set, session):
     url = "https://www.ncbi.nlm.nih.gov/research/pubtator-api/agentapi/ppi/?"
     params = {
         "name": gene_set,
         "retmode": "json",
         "limit": 50
         }
-    response = requests.get(url, params=params)
-
-    if response.status_code == 200:
-        return json.dumps(response.json().get("results",{}))
-    else:
-        return f"Error: Unable to fetch data (Status Code: {response.status_code})"
+    async with session.get(url, params=params) as response:
+        if response.status == 200:
+            return json.dumps((await response.json(content_type=None)).get("results",{}))
+        else:
+            return f"Error: Unable to fetch data (Status Code: {response.status})"
 
 get_interactions_for_gene_set_doc = {
 	"name": "get_interactions_for_gene_set",
@@ -1,7 +1,8 @@
 import json
-import requests
+import asyncio
+import aiohttp
 
-def get_pathway_for_gene_set(gene_set):
+async def get_pathway_for_gene_set(gene_set, session):
     """
     The returned values are Rank, Term name, P-value, Odds ratio, Combined score, Overlapping genes, Adjusted p-value, Old p-value, Old adjusted p-value
     """
@@ -9,27 +10,32 @@ def get_pathway_for_gene_set(gene_set):
     gene_list = gene_set.split(",")
 
     ENRICHR_URL_ADD = 'http://maayanlab.cloud/Enrichr/addList'
-    payload = {
-        'list': (None, '\n'.join(gene_list)),
-        'description': (None, 'My gene set')
-    }
-    response_add = requests.post(ENRICHR_URL_ADD, files=payload)
+    with aiohttp.MultipartWriter('form-data') as payload:
+        payload.append('\n'.join(gene_list)).set_content_disposition('form-data', name='list')
+        payload.append('My gene set').set_content_disposition('form-data', name='description')
+    async with session.post(ENRICHR_URL_ADD, data=payload) as response_add:
+        text_add = await response_add.text()
+        if not response_add.ok:
+            raise Exception('Error adding list to Enrichr:', text_add)
 
-    if not response_add.ok:
-        raise Exception('Error adding list to Enrichr:', response_add.text)
-
-    data = json.loads(response_add.text)
+    data = json.loads(text_add)
     list_id = data['userListId']
+
+    async def fetch_results(backgroundType):
+        ENRICHR_URL_RESULTS = f'http://maayanlab.cloud/Enrichr/enrich?userListId={list_id}&backgroundType={backgroundType}'
+        async with session.get(ENRICHR_URL_RESULTS) as response_results:
+            text_results = await response_results.text()
+            if not response_results.ok:
+                raise Exception('Error fetching pathway results:', text_results)
+        return json.loads(text_results)
+
+    ## the libraries are independent, query them together
+    backgroundTypes = ["KEGG_2021_Human", "Reactome_2022", "BioPlanet_2019", "MSigDB_Hallmark_2020"]
+    results = await asyncio.gather(*[fetch_results(backgroundType) for backgroundType in backgroundTypes])
     dic = {}
-    for backgroundType in ["KEGG_2021_Human", "Reactome_2022", "BioPlanet_2019", "MSigDB_Hallmark_2020"]:
+    for backgroundType, result in zip(backgroundTypes, results):
         try:
-            ENRICHR_URL_RESULTS = f'http://maayanlab.cloud/Enrichr/enrich?userListId={list_id}&backgroundType={backgroundType}'
-            response_results = requests.get(ENRICHR_URL_RESULTS)
-            
-            if not response_results.ok:
-                raise Exception('Error fetching pathway results:', response_results.text)
-            
-            pathway_data = response_results.json()[backgroundType]
+            pathway_data = result[backgroundType]
             for value in pathway_data[:3]:
                 dic[value[1]] = [value[2],",".join(value[5]), backgroundType]
         except TypeError:
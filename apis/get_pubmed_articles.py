@@ -1,8 +1,7 @@
 import json
-import requests
 from xml.etree import ElementTree
 
-def get_pubmed_articles(term):
+async def get_pubmed_articles(term, session):
     base_url_pubmed = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
     search_url = f"{base_url_pubmed}/esearch.fcgi"
     fetch_url = f"{base_url_pubmed}/efetch.fcgi"
@@ -13,9 +12,12 @@ def get_pubmed_articles(term):
         "retmax": "5",
         "sort": "relevance"
     }
-    search_response = requests.get(search_url, params=search_params)
+    async with session.get(search_url, params=search_params) as search_response:
+        if search_response.status != 200:
+            return f"Error: Unable to fetch data (Status Code: {search_response.status})"
+        search_content = await search_response.read()
     try:
-        search_results = ElementTree.fromstring(search_response.content)
+        search_results = ElementTree.fromstring(search_content)
         id_list = [id_tag.text for id_tag in search_results.findall('.//Id')]
     except ElementTree.ParseError as e:
         return f"Error parsing search results: {e}"
@@ -28,10 +30,13 @@ def get_pubmed_articles(term):
         "id": ",".join(id_list),
         "retmode": "xml"
     }
-    fetch_response = requests.get(fetch_url, params=fetch_params)
+    async with session.get(fetch_url, params=fetch_params) as fetch_response:
+        if fetch_response.status != 200:
+            return f"Error: Unable to fetch data (Status Code: {fetch_response.status})"
+        fetch_content = await fetch_response.read()
     
     try:
-        articles = ElementTree.fromstring(fetch_response.content)
+        articles = ElementTree.fromstring(fetch_content)
     except ElementTree.ParseError as e:
         return f"Error parsing fetch results: {e}"
 
@@ -0,0 +1,129 @@
+import os
+import hashlib
+
+import orjson
+
+import openai
+## Set your own Azure OpenAI key and endpoint in the environment
+openai.api_type = os.getenv("OPENAI_API_TYPE", "azure")
+openai.api_base = os.getenv("OPENAI_API_BASE", "***************")
+openai.api_version = os.getenv("OPENAI_API_VERSION", "***************")
+openai.api_key = os.getenv("OPENAI_API_KEY", "**********************")
+MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+## the claim generation steps only return a short list of claims, a smaller deployment is enough
+CLAIM_MODEL = os.getenv("CLAIM_MODEL", "gpt-4o-mini")
+
+import diskcache
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+## identical requests are answered from disk, which also makes reruns reproducible
+llm_cache = diskcache.Cache(".llm")
+
+## only back off when the service asks for it instead of sleeping before every request
+wait_backoff = wait_exponential_jitter(initial=1, max=30)
+## a large Retry-After header should not stall a worker for longer than this
+MAX_RETRY_AFTER = 60
+
+def wait_retry_after(retry_state):
+	headers = getattr(retry_state.outcome.exception(), "headers", None) or {}
+	try:
+		return min(max(float(headers.get("retry-after")), 0), MAX_RETRY_AFTER)
+	except (TypeError, ValueError):
+		return wait_backoff(retry_state)
+
+## APIError covers the 500/502/504 gateway errors and TryAgain the 409 conflicts
+TRANSIENT_ERRORS = (
+	openai.error.APIError,
+	openai.error.TryAgain,
+	openai.error.RateLimitError,
+	openai.error.Timeout,
+	openai.error.ServiceUnavailableError,
+	openai.error.APIConnectionError,
+)
+
+@retry(
+	wait=wait_retry_after,
+	retry=retry_if_exception_type(TRANSIENT_ERRORS),
+	stop=stop_after_attempt(6),
+	reraise=True,
+)
+async def chat_completion(**kwargs):
+	return await openai.ChatCompletion.acreate(**kwargs)
+
+## structured output for the claim generation steps, the root of a json schema has to be an object
+claims_format = {
+	"type": "json_schema",
+	"json_schema": {
+		"name": "claims",
+		"strict": True,
+		"schema": {
+			"type": "object",
+			"properties": {
+				"claims": {"type": "array", "items": {"type": "string"}}
+			},
+			"required": ["claims"],
+			"additionalProperties": False,
+		},
+	},
+}
+
+def parse_claims(content):
+	claims = orjson.loads(content)["claims"]
+	if not all(isinstance(claim, str) for claim in claims):
+		raise ValueError(f"Claims should be a list of strings: {claims}")
+	return claims
+
+def cache_key(model, messages, temperature, **kwargs):
+	request = orjson.dumps([model, messages, temperature, kwargs], option=orjson.OPT_SORT_KEYS)
+	return hashlib.sha256(request).hexdigest()
+
+async def chat(messages, model=MODEL, temperature=0, cache=True, **kwargs):
+	"""Return the reply message of a chat completion as a dict, cache=False always queries the model."""
+	key = cache_key(model, messages, temperature, **kwargs)
+	message = llm_cache.get(key) if cache else None
+	if message is None:
+		completion = await chat_completion(
+			engine=model,
+			messages=messages,
+			temperature=temperature,
+			**kwargs,
+		)
+		message = completion.choices[0]["message"].to_dict_recursive()
+		if cache:
+			llm_cache.set(key, message)
+	return message
+
+async def stream_chat(messages, on_first_line=None, model=MODEL, temperature=0):
+	"""Stream a reply and return its content, on_first_line gets the first line as soon as it arrives."""
+	key = cache_key(model, messages, temperature)
+	message = llm_cache.get(key)
+	if message is not None:
+		if on_first_line is not None:
+			on_first_line(message["content"].partition("\n")[0])
+		return message["content"]
+
+	response = await chat_completion(
+		engine=model,
+		messages=messages,
+		temperature=temperature,
+		stream=True,
+	)
+	chunks = []
+	first_line = None
+	async for chunk in response:
+		## Azure sends the prompt filter results in a chunk without choices
+		if not chunk.choices:
+			continue
+		delta = chunk.choices[0]["delta"].get("content")
+		if not delta:
+			continue
+		chunks.append(delta)
+		if on_first_line is not None and first_line is None and "\n" in delta:
+			first_line = "".join(chunks).partition("\n")[0]
+			on_first_line(first_line)
+
+	content = "".join(chunks)
+	if on_first_line is not None and first_line is None:
+		on_first_line(content)
+	llm_cache.set(key, {"role": "assistant", "content": content})
+	return content
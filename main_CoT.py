@@ -1,13 +1,9 @@
 import json
 import time
+import asyncio
 import pandas as pd
 
-import openai
-## Replace with your own OpenAI model and key
-openai.api_type = "azure"
-openai.api_base = "***************"
-openai.api_version = "*****************"
-openai.api_key = "**************************" 
+from llm import chat
 
 from worker import AgentPhD
 from topic import topic_verification
@@ -39,13 +35,9 @@ if __name__ == "__main__":
             {"role":"system", "content":system},
             {"role":"user", "content":prompt_baseline}
         ]
-        summary = openai.ChatCompletion.create(
-			engine="gpt-4o",
-			messages=messages,
-			temperature=0.0,
-			)
-        messages.append(summary.choices[0]["message"])
-        summary = summary.choices[0]["message"]["content"]
+        summary = asyncio.run(chat(messages))
+        messages.append(summary)
+        summary = summary["content"]
         with open("Outputs/Chain-of-Thought/MsigDB_Response_CoT.txt","a") as f_update:
             f_update.write(summary+"\n")
             f_update.write("//\n")
@@ -1,14 +1,10 @@
 import json
 import time
+import asyncio
 import pandas as pd
 from datetime import datetime
 
-import openai
-## Replace with your own OpenAI model and key
-openai.api_type = "azure"
-openai.api_base = "***************"
-openai.api_version = "*****************"
-openai.api_key = "**************************" 
+from llm import chat
 
 from worker import AgentPhD
 
@@ -106,13 +102,9 @@ if __name__ == "__main__":
             {"role":"system", "content":system},
             {"role":"user", "content":prompt}
         ]
-        summary = openai.ChatCompletion.create(
-			engine="gpt-4o",
-			messages=messages,
-			temperature=0,
-			)
+        summary = asyncio.run(chat(messages))
 
-        summary = summary.choices[0]["message"]["content"]
+        summary = summary["content"]
         with open("Outputs/EnrichedTermTest/gpt.geneagent.msigdb.summary.result.verification.txt","a") as f_summary:
             f_summary.write(summary+"\n")
             f_summary.write("//\n")
@@ -1,14 +1,7 @@
-import json
-import time
 import re
 import pandas as pd
 
-import openai
-## Replace with your own OpenAI model and key
-openai.api_type = "azure"
-openai.api_base = "***************"
-openai.api_version = "*****************"
-openai.api_key = "**************************" 
+from llm import CLAIM_MODEL, chat, claims_format, parse_claims
 
 
 ## topic verification
@@ -16,7 +9,7 @@ system_verify = "You are a helpful and objective fact-checker to verify the proc
 topic = lambda genes, process: f"""
 Here is the vanilla process name for the human gene set {genes}:\n{process}
 However, the process name might be false. Please generate decontextualized claims for the process name that need to be verified.
-Please return JSON list only containing the generated strings of claims:
+Please return a JSON object only, whose "claims" list contains the generated strings of claims, for example, {{"claims": ["claim_1", "claim_2"]}}:
 """
 topic_instruction = """
 Generate claims of affirmative sentences about the prominent biological process for the entire gene set.
@@ -26,30 +19,28 @@ Don't generate hypotheis claims over the previous analysis like diseases, mutati
 Please replace the statement like 'these genes', 'this system' with the entire gene set.
 """
 
-def topic_verification(genes, process_name, agentphd):  
-    pattern = re.compile(r'^[a-zA-Z0-9_-]+$')
+pattern = re.compile(r'^[a-zA-Z0-9_-]+$')
+claim_tail = re.compile(r'[^a-zA-Z0-9,.;?!*()_-]+$')
+
+async def topic_verification(genes, process_name, agentphd):  
     ## send genes and summary to GPT-4 and generate claims for verifying topic name
     prompt_topic = topic(genes, process_name) + topic_instruction
     message = [
         {"role":"system", "content":system_verify},
         {"role":"user", "content":prompt_topic}
     ]
-    claims = openai.ChatCompletion.create(
-        engine="gpt-4o",
-        messages=message,
-        temperature=0.0,
-        )
-    claims = json.loads(claims.choices[0]["message"]["content"])
+    claims = await chat(message, model=CLAIM_MODEL, response_format=claims_format)
+    claims = parse_claims(claims["content"])
     print("=====Topic Claim=====")
     print(claims)
     
-    verification = ""
-    for claim in claims:
-        if not re.match(pattern, claim):
-            claim = re.sub(r'[^a-zA-Z0-9,.;?!*()_-]+$', "_", claim)
-        claim_result = agentphd.inference(claim)
-        verification += f"Original_claim:{claim}"
-        verification += f"Verified_claim:{claim_result}"
+    claims = [claim if pattern.match(claim) else claim_tail.sub("_", claim) for claim in claims]
+    claim2report = await agentphd.inference_batch(claims)
+    claim_results = [claim2report[claim] for claim in claims]
+
+    verification_parts = []
+    for claim, claim_result in zip(claims, claim_results):
+        verification_parts.extend(("Original_claim:", claim, "Verified_claim:", claim_result))
         with open("Verification Reports/Synchronous/Claims_and_Verification_for_MsigDB.txt","a") as f_claim:
             f_claim.write(str(claim)+"\n")
             f_claim.write(str(claim_result)+"\n")
@@ -57,6 +48,7 @@ def topic_verification(genes, process_name, agentphd):
         print(claim)
         print(claim_result)
         
+    verification = "".join(verification_parts)
     ## send verificaton report to GPT-4 and modify the original process name
     message.append(
         {"role":"assistant", "content":f"There should be only one most significant function name. If the process name is direclty supported in all verifications, the significant function is the name that most similar to the original process name but reflects more specific biological regulation mechanism. Otherwise, it is the first (top-1) function name in verifications."}
@@ -64,14 +56,10 @@ def topic_verification(genes, process_name, agentphd):
     message.append(
         {"role":"user", "content":f"I have finished the verification for the process name, here is the verification report:{verification}\nPlease replace the process name with the most significant function of gene set.\nPlease start a message with \"Topic:\" and only return the brief revised name."}
     )
-    updated = openai.ChatCompletion.create(
-        engine="gpt-4o",
-        messages=message,
-        temperature=0.0,
-        )
+    updated = await chat(message)
 
     # messages.append(updated_topic.choices[0]["message"])
-    updated = updated.choices[0]["message"]["content"]
+    updated = updated["content"]
 
     print("=====Updated Topic=====")
     print(updated)
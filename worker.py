@@ -1,22 +1,38 @@
 import openai
-openai.api_type = "azure"
-openai.api_base = "***************"
-openai.api_version = "***************"
-openai.api_key = "**********************"
+from llm import chat
 
 import os
-import time
-import json
+import orjson
+import asyncio
 import re
+import pickle
+import hashlib
+import functools
+from collections import OrderedDict
+
+import aiohttp
+import diskcache
+import numpy as np
+try:
+	import faiss
+except ImportError:
+	faiss = None
 
 import logging
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 import tiktoken
 MAX_TOKENS = 127900
 encoding = tiktoken.encoding_for_model("gpt-4")
 
+## the prompt templates repeat across claims and gene sets, so only tokenize each text once
+@functools.lru_cache(maxsize=4096)
+def token_length(text):
+	return len(encoding.encode(text))
+
 from apis.get_complex_for_gene_set import get_complex_for_gene_set, get_complex_for_gene_set_doc 
 from apis.get_disease_for_single_gene import get_disease_for_single_gene, get_disease_for_single_gene_doc
 from apis.get_domain_for_single_gene import get_domain_for_single_gene, get_domain_for_single_gene_doc
@@ -39,108 +55,427 @@ func2info = {
 }
 
 pattern = re.compile(r'^[a-zA-Z0-9_-]+$')
+report_tail = re.compile(r'[^a-zA-Z0-9_-]+$')
+MAX_PARALLEL_TOOLS = 4
+## tool calls per claim after which the model is forced to submit its report
+MIN_TOOL_CALLS = 3
+
+submit_report_doc = {
+	"name": "submit_report",
+	"description": "Submit the verification report of the claim once the tools have returned enough evidences.",
+	"parameters": {
+		"type": "object",
+		"properties": {
+			"report": {
+				"type": "string",
+				"description": "The decision on the claim followed by the findings."
+				},
+			"evidence": {
+				"type": "array",
+				"items": {"type": "string"},
+				"description": "The evidences returned by the tools that support the decision."
+				}
+			},
+		"required": ["report", "evidence"],
+	},
+}
+
+submit_reports_doc = {
+	"name": "submit_reports",
+	"description": "Submit the verification reports of all claims once the tools have returned enough evidences.",
+	"parameters": {
+		"type": "object",
+		"properties": {
+			"reports": {
+				"type": "array",
+				"items": {
+					"type": "object",
+					"properties": {
+						"id": {"type": "integer", "description": "The id of the claim."},
+						"report": {"type": "string", "description": "The decision on the claim followed by the findings."},
+						"evidence": {"type": "array", "items": {"type": "string"}, "description": "The evidences returned by the tools that support the decision."}
+						},
+					"required": ["id", "report", "evidence"]
+					}
+				}
+			},
+		"required": ["reports"],
+	},
+}
+
+## verification reports and API responses are reused across gene sets and reruns.
+## Hot entries are kept in memory in front of the persistent cache on disk.
+cache = diskcache.Cache(".agent_cache")
+CACHE_EXPIRE = 7 * 24 * 3600
+MEMO_SIZE = 10_000
+memo = OrderedDict()
+missing = object()
+
+def cache_get(key):
+	if key in memo:
+		memo.move_to_end(key)
+		return memo[key]
+	value = cache.get(key, default=missing)
+	if value is not missing:
+		memo_set(key, value)
+	return value
+
+def cache_set(key, value):
+	memo_set(key, value)
+	cache.set(key, value, expire=CACHE_EXPIRE)
+
+def memo_set(key, value):
+	memo[key] = value
+	memo.move_to_end(key)
+	if len(memo) > MEMO_SIZE:
+		memo.popitem(last=False)
+
+def cached_function(function_name, function):
+	"""Wrap an API so that its successful responses are cached, the shared HTTP session is not part of the key."""
+	async def wrapper(session, **function_params):
+		key = (function_name, orjson.dumps(function_params, option=orjson.OPT_SORT_KEYS).decode())
+		response = cache_get(key)
+		if response is missing:
+			response = await function(session=session, **function_params)
+			## failed requests should be retried next time instead of replayed
+			if not (isinstance(response, str) and response.startswith("Error")):
+				cache_set(key, response)
+		return response
+	return wrapper
+
+def normalize_claim(claim):
+	return " ".join(claim.lower().split())
+
+## near-duplicate claims reuse the report of the most similar cached claim
+EMBEDDING_ENGINE = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.95
+FAISS_MIN_SIZE = 10_000
+
+async def embed_claim(claim):
+	try:
+		response = await openai.Embedding.acreate(engine=EMBEDDING_ENGINE, input=claim)
+	except openai.error.OpenAIError as E:
+		print(f"=====The claim embedding is unavailable: {E}=====")
+		return None
+	embedding = np.asarray(response["data"][0]["embedding"], dtype=np.float32)
+	return embedding / np.linalg.norm(embedding)
+
+## the semantic cache is written to disk every SEMANTIC_SAVE_EVERY new reports and when the agent is closed
+SEMANTIC_SAVE_EVERY = 100
+
+class SemanticCache:
+	"""L2-normalized claim embeddings and their reports, persisted with numpy and pickle."""
+	def __init__(self, path):
+		self.path = path
+		## embeddings are appended to a buffer that doubles when full, only its first self.size rows are used
+		self.buffer = None
+		self.size = 0
+		self.reports = []
+		self.index = None
+		self.unsaved = 0
+		if os.path.exists(path + ".npy") and os.path.exists(path + ".pkl"):
+			embeddings = np.load(path + ".npy")
+			with open(path + ".pkl", "rb") as f_reports:
+				reports = pickle.load(f_reports)
+			## both files grow together, so after an interrupted save the shorter one is still a consistent prefix
+			if len(embeddings) != len(reports):
+				print(f"=====The semantic cache has {len(embeddings)} embeddings but {len(reports)} reports, keep the common prefix=====")
+				size = min(len(embeddings), len(reports))
+				embeddings, reports = embeddings[:size], reports[:size]
+			self.buffer = np.array(embeddings, dtype=np.float32)
+			self.size = len(reports)
+			self.reports = reports
+
+	@property
+	def embeddings(self):
+		return self.buffer[:self.size]
+
+	def lookup(self, query):
+		if not self.reports:
+			return None
+		## exact inner product search, faiss only pays off for large caches
+		if faiss is not None and len(self.reports) > FAISS_MIN_SIZE:
+			if self.index is None:
+				self.index = faiss.IndexFlatIP(self.buffer.shape[1])
+				self.index.add(self.embeddings)
+			similarities, ids = self.index.search(query[None], 1)
+			best, similarity = int(ids[0][0]), similarities[0][0]
+		else:
+			similarities = self.embeddings @ query
+			best = int(similarities.argmax())
+			similarity = similarities[best]
+		if similarity > SIMILARITY_THRESHOLD:
+			return self.reports[best]
+		return None
+
+	def add(self, query, report):
+		if self.buffer is None:
+			self.buffer = np.empty((64, len(query)), dtype=np.float32)
+		elif self.size == len(self.buffer):
+			buffer = np.empty((2 * len(self.buffer), self.buffer.shape[1]), dtype=np.float32)
+			buffer[:self.size] = self.embeddings
+			self.buffer = buffer
+		self.buffer[self.size] = query
+		self.size += 1
+		self.reports.append(report)
+		if self.index is not None:
+			self.index.add(query[None])
+		self.unsaved += 1
+		if self.unsaved >= SEMANTIC_SAVE_EVERY:
+			self.save()
+
+	def save(self):
+		if not self.unsaved:
+			return
+		## each file is written next to the old one and swapped in, so a crash never leaves a truncated file
+		for suffix, dump in [(".npy", lambda f: np.save(f, self.embeddings)), (".pkl", lambda f: pickle.dump(self.reports, f))]:
+			with open(self.path + suffix + ".tmp", "wb") as f_tmp:
+				dump(f_tmp)
+			os.replace(self.path + suffix + ".tmp", self.path + suffix)
+		self.unsaved = 0
+
+## NCBI allows 3 E-utilities requests per second without an api key, the other hosts are only bounded per connection
+EUTILS_HOST = "eutils.ncbi.nlm.nih.gov"
+EUTILS_INTERVAL = 1 / 3
+
+class HostRateLimiter:
+	"""Space out the requests to one host, hooked into the session as an aiohttp trace callback."""
+	def __init__(self, host, interval):
+		self.host = host
+		self.interval = interval
+		self.next_time = 0.0
+
+	async def on_request_start(self, session, context, params):
+		if params.url.host != self.host:
+			return
+		now = asyncio.get_running_loop().time()
+		wait = self.next_time - now
+		self.next_time = max(now, self.next_time) + self.interval
+		if wait > 0:
+			await asyncio.sleep(wait)
 
 class AgentPhD:
 	def __init__(self, function_names):
-		self.name2function = {function_name: func2info[function_name][0] for function_name in function_names}
-		self.function_docs = [func2info[function_name][1] for function_name in function_names]
+		self.name2function = {function_name: cached_function(function_name, func2info[function_name][0]) for function_name in function_names}
+		## reports depend on the available tools, e.g. the Gene Ontology run excludes the enrichment API
+		self.cache_scope = ",".join(sorted(function_names))
+		scope_hash = hashlib.md5(self.cache_scope.encode()).hexdigest()[:8]
+		self.semantic_cache = SemanticCache(os.path.join(cache.directory, f"claims_{scope_hash}"))
+		self.function_docs = [{"type": "function", "function": func2info[function_name][1]} for function_name in function_names]
+		## one pooled HTTP session keeps the connections to the domain databases alive across tool calls,
+		## it is created on first use because it has to live in the running event loop
+		self.session = None
+
+	async def get_session(self):
+		if self.session is None or self.session.closed:
+			trace_config = aiohttp.TraceConfig()
+			trace_config.on_request_start.append(HostRateLimiter(EUTILS_HOST, EUTILS_INTERVAL).on_request_start)
+			self.session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=32, limit_per_host=8, ttl_dns_cache=300),
+				trace_configs=[trace_config],
+			)
+		return self.session
+
+	async def close(self):
+		self.semantic_cache.save()
+		if self.session is not None:
+			await self.session.close()
+
+	async def call_function(self, tool_call, semaphore):
+		function_name = tool_call["function"]["name"]
+		function_params = {}
+		try:
+			function_params = orjson.loads(tool_call["function"]["arguments"])
+			function_to_call = self.name2function[function_name]
+			async with semaphore:
+				function_response = await function_to_call(await self.get_session(), **function_params)
+			function_response = f"Function has been called with params {function_params}, and returns {function_response}."
+
+		except Exception as E:
+			function_response = f"Function has been called with params {function_params}, but returned error: {E}. Please try again with the correct parameter."
 
-	def inference(self, claim):
+		return {
+			"role": "tool",
+			"tool_call_id": tool_call["id"],
+			"content": function_response
+		}
+
+	async def lookup_report(self, claim):
+		"""Return the cached report of a claim, with the cache key and claim embedding to store a new one."""
+		key = ("inference", self.cache_scope, normalize_claim(claim))
+		report = cache_get(key)
+		if report is not missing:
+			return report, key, None
+		query = await embed_claim(claim)
+		report = self.semantic_cache.lookup(query) if query is not None else None
+		if report is not None:
+			cache_set(key, report)
+		return report, key, query
+
+	def store_report(self, key, query, report):
+		if report == "Failed.":
+			return
+		cache_set(key, report)
+		if query is not None:
+			self.semantic_cache.add(query, report)
+
+	async def inference(self, claim):
+		report, key, query = await self.lookup_report(claim)
+		if report is None:
+			report = await self.verify_claim(claim)
+			self.store_report(key, query, report)
+		return report
+
+	async def inference_batch(self, claims):
+		"""Verify several claims in one tool-using conversation, return a dict from claim to report."""
+		lookups = await asyncio.gather(*[self.lookup_report(claim) for claim in claims])
+		claim2report, pending = {}, {}
+		for claim, (report, key, query) in zip(claims, lookups):
+			if report is not None:
+				claim2report[claim] = report
+			else:
+				pending.setdefault(claim, (key, query))
+
+		ids = {claim: ind for ind, claim in enumerate(pending, start=1)}
+		reports = await self.verify_claims(list(pending)) if len(pending) > 1 else {}
+		## claims missed by the batch reply are verified one by one
+		missed = [claim for claim in pending if ids[claim] not in reports]
+		results = await asyncio.gather(*[self.verify_claim(claim) for claim in missed])
+		for claim, report in zip(missed, results):
+			reports[ids[claim]] = report
+
+		for claim, (key, query) in pending.items():
+			claim2report[claim] = reports[ids[claim]]
+			self.store_report(key, query, reports[ids[claim]])
+		return claim2report
+
+	async def verify_claim(self, claim):
     
 		system = f"""
   		You are a helpful fact-checker. 
     	Your task is to verify the claim using the provided tools. 
-     	If there are evidences in your contents, please start a message with "Report:" and return your findings along with evidences.
+     	If there are evidences in your contents, please call submit_report to return your findings along with evidences.
     	"""
 		content = f"""
   		Here is the claim needed to be verified:\n{claim} 
 		Try to use multiple tools to verify a claim and the verification process should be factual and objective.
-    	Put your decision at the beginning of the evidences.
+    	Put your decision at the beginning of the report.
     	Don't use any format symbols such as '*', '-' or other tokens.
     	"""
-		token_verification = encoding.encode(content + system)
-		print(f"=====The prompt tokens input to the verification step is {len(token_verification)}=====")
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug(f"The prompt tokens input to the verification step is {token_length(content + system)}")
+		message_verification = [
+			{"role": "system", "content": system},
+			{"role": "user", "content": content} 
+		]
+		report = await self.converse(message_verification, submit_report_doc, format_report, MIN_TOOL_CALLS)
+		return report if report is not None else "Failed."
+
+	async def verify_claims(self, claims):
+		"""Return a dict from the 1-based claim id to its report, claims missing from the reply are left out."""
+		system = f"""
+  		You are a helpful fact-checker. 
+    	Your task is to verify each of the claims using the provided tools. 
+     	If there are evidences for all claims in your contents, please call submit_reports to return the findings along with evidences of each claim id.
+    	"""
+		numbered = "\n".join(f"{ind}. {claim}" for ind, claim in enumerate(claims, start=1))
+		content = f"""
+  		Here are the claims needed to be verified:\n{numbered} 
+		Try to use multiple tools to verify each claim and the verification process should be factual and objective.
+    	Tools shared by several claims only need to be called once.
+    	Put your decision at the beginning of the report of each claim.
+    	Don't use any format symbols such as '*', '-' or other tokens in the reports.
+    	"""
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug(f"The prompt tokens input to the batch verification step is {token_length(content + system)}")
 		message_verification = [
 			{"role": "system", "content": system},
 			{"role": "user", "content": content} 
 		]
+		reports = await self.converse(message_verification, submit_reports_doc, parse_batch_reports, MIN_TOOL_CALLS * len(claims))
+		return reports if reports is not None else {}
 
+	async def converse(self, message_verification, submit_doc, parse_submission, min_tool_calls):
+		"""Let the model call tools until it submits its answer through submit_doc, None if it never does."""
+		tools = self.function_docs + [{"type": "function", "function": submit_doc}]
+		## once enough evidences are gathered, the model has to submit instead of replying in text
+		force_submit = {"type": "function", "function": {"name": submit_doc["name"]}}
+		tool_choice = "auto"
+		tool_calls = 0
+		## limit the concurrent requests one conversation sends to the domain databases
+		tool_semaphore = asyncio.Semaphore(MAX_PARALLEL_TOOLS)
 		loop = 0
 		while loop < 20:
 			loop += 1
-			# logger.info(f"Input@{loop}\n" +  json.dumps(messages, indent=4))
-			time.sleep(1)
-			completion = openai.ChatCompletion.create(
-				engine="gpt-4o",
-				messages=message_verification,
-				functions=self.function_docs,
-				temperature=0,
+			# logger.info(f"Input@{loop}\n" + orjson.dumps(message_verification, option=orjson.OPT_INDENT_2).decode())
+			## the turns are not cached, the report cache covers finished verifications and a failed one has to run again
+			message = await chat(
+				message_verification,
+				tools=tools,
+				tool_choice=tool_choice,
+				cache=False,
 			)
-
-			message = completion.choices[0]["message"]
 			# token_message_output = encoding.encode(str(message))
 			# print(f"=====The message tokens output from the verification step is {len(token_message_output)}=====")
-			# logger.info(f"Output@{loop}\n" +  json.dumps(message, indent=4))
-
-			if "function_call" in message:
-				try:
-					function_name = message["function_call"]["name"]
-					function_params = json.loads(message["function_call"]["arguments"])
-					function_to_call = self.name2function[function_name]
-					function_response = function_to_call(**function_params)
-					function_response = f"Function has been called with params {function_params}, and returns {function_response}."
-
-					message_verification.append(
-						{
-							"role": "function",
-							"name": function_name,
-							"content": function_response
-						},
-					)
-					# token_message_verification = encoding.encode(str(message_verification))
-					# print(f"=====The message tokens input to verification step is {len(token_message_verification)}=====")
-
-				except Exception as E:
-					message_verification.append(
-						{
-							"role": "function",
-							"name": function_name,
-							"content": f"Function has been called with params {function_params}, but returned error: {E}. Please try again with the correct parameter.",
-						}
-					)
-					# token_message_verification = encoding.encode(str(message_verification))
-					# print(f"=====The message tokens input to verification step is {len(token_message_verification)}=====")
-			
-			else:
-				try:
-					if "Report: " in message["content"]:
-						report = message["content"].split("Report: ")[-1]
-						token_report = encoding.encode(report)
-						print(f"=====The output tokens of verification report in the verification step is {len(token_report)}=====")
-						if re.match(pattern, report):
-							return report
-						else: 
-							return re.sub(r'[^a-zA-Z0-9_-]+$', "_", report)
-					
-					else:
+			# logger.info(f"Output@{loop}\n" + orjson.dumps(message, option=orjson.OPT_INDENT_2).decode())
+
+			if message.get("tool_calls"):
+				submission_error = None
+				for tool_call in message["tool_calls"]:
+					if tool_call["function"]["name"] == submit_doc["name"]:
+						try:
+							return parse_submission(orjson.loads(tool_call["function"]["arguments"]))
+						except Exception as E:
+							submission_error = E
+
+				## the model may request several tools in one turn, run them together and answer each call
+				message_verification.append(message)
+				function_responses = await asyncio.gather(
+					*[self.call_function(tool_call, tool_semaphore) for tool_call in message["tool_calls"] if tool_call["function"]["name"] != submit_doc["name"]]
+				)
+				message_verification.extend(function_responses)
+				for tool_call in message["tool_calls"]:
+					if tool_call["function"]["name"] == submit_doc["name"]:
 						message_verification.append(
 							{
-								"role": "user",
-								"content": f"please start a message with \"Report:\" and return your findings if you have obtained the verification information.",
+								"role": "tool",
+								"tool_call_id": tool_call["id"],
+								"content": f"Report has been submitted, but returned error: {submission_error}. Please try it again.",
 							}
 						)
-						# token_message_verification = encoding.encode(str(message_verification))
-						# print(f"=====The message tokens input to verification step is {len(token_message_verification)}=====")
-      
-				except Exception as E:
-					message_verification.append(
-						{
-							"role": "assistant",
-							"content": f"Claim has been verified, but returned error: {E}. Please try it again.",
-						}
-					)
-					# token_message_verification = encoding.encode(str(message_verification))
-					# print(f"=====The message tokens input to verification step is {len(token_message_verification)}=====")
-					# print(E)
-
-		return "Failed."	
+				tool_calls += len(function_responses)
+				if tool_calls >= min_tool_calls:
+					tool_choice = force_submit
+				# token_message_verification = encoding.encode(str(message_verification))
+				# print(f"=====The message tokens input to verification step is {len(token_message_verification)}=====")
+			
+			else:
+				message_verification.append(message)
+				message_verification.append(
+					{
+						"role": "user",
+						"content": f"please call {submit_doc['name']} to return your findings if you have obtained the verification information.",
+					}
+				)
+				tool_choice = force_submit
+				# token_message_verification = encoding.encode(str(message_verification))
+				# print(f"=====The message tokens input to verification step is {len(token_message_verification)}=====")
+
+		return None
+
+def sanitize_report(report):
+	if re.match(pattern, report):
+		return report
+	return report_tail.sub("_", report)
+
+def format_report(submission):
+	report = str(submission["report"])
+	evidence = submission.get("evidence") or []
+	if evidence:
+		report += " Evidences: " + " ".join(str(item) for item in evidence)
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug(f"The output tokens of verification report in the verification step is {token_length(report)}")
+	return sanitize_report(report)
+
+def parse_batch_reports(submission):
+	return {int(item["id"]): format_report(item) for item in submission["reports"]}